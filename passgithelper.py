@@ -5,30 +5,53 @@
 .. codeauthor:: Johannes Wienke
 """
 
+from __future__ import annotations
 
 import abc
-import argparse
-import configparser
-import fnmatch
+import functools
 import logging
 import os
-import os.path
 from pathlib import Path
 import re
-import subprocess
 import sys
-from typing import Dict, IO, Mapping, Optional, Pattern, Sequence, Text
+from typing import (
+    Dict,
+    FrozenSet,
+    IO,
+    Mapping,
+    Optional,
+    Pattern,
+    Sequence,
+    Text,
+    TYPE_CHECKING,
+)
+
 
-import xdg.BaseDirectory
+# Modules only needed on some code paths are imported lazily where they are used.
+# The helper is spawned for every git operation requiring credentials and
+# exit paths like PASS_GIT_HELPER_SKIP should not pay for unused imports.
+if TYPE_CHECKING:
+    import argparse
+    import configparser
 
 
 __version__ = "3.2.0"
 
-LOGGER = logging.getLogger()
+LOGGER = logging.getLogger("passgithelper")
 CONFIG_FILE_NAME = "git-pass-mapping.ini"
-DEFAULT_CONFIG_FILE = (
-    Path(xdg.BaseDirectory.save_config_path("pass-git-helper")) / CONFIG_FILE_NAME
-)
+
+
+def _default_config_file() -> Path:
+    """Return the location of the mapping file in the user's XDG config dir.
+
+    The path is only computed and not created on disk so that invocations
+    using an explicit mapping file do not touch the file system for it.
+    """
+    import xdg.BaseDirectory
+
+    return (
+        Path(xdg.BaseDirectory.xdg_config_home) / "pass-git-helper" / CONFIG_FILE_NAME
+    )
 
 
 def parse_arguments(argv: Optional[Sequence[str]] = None) -> argparse.Namespace:
@@ -42,6 +65,8 @@ def parse_arguments(argv: Optional[Sequence[str]] = None) -> argparse.Namespace:
     Returns:
         The argparse object representing the parsed arguments.
     """
+    import argparse
+
     parser = argparse.ArgumentParser(
         description="Git credential helper using pass as the data source.",
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
@@ -49,13 +74,14 @@ def parse_arguments(argv: Optional[Sequence[str]] = None) -> argparse.Namespace:
     parser.add_argument(
         "-m",
         "--mapping",
-        type=argparse.FileType("r"),
+        type=Path,
         metavar="MAPPING_FILE",
         default=None,
         help="A mapping file to be used, specifying how hosts "
         "map to pass entries. Overrides the default mapping files from "
-        "XDG config locations, usually: {config_file}".format(
-            config_file=DEFAULT_CONFIG_FILE
+        "XDG config locations, usually: "
+        "$XDG_CONFIG_HOME/pass-git-helper/{config_file}".format(
+            config_file=CONFIG_FILE_NAME
         ),
     )
     parser.add_argument(
@@ -75,7 +101,7 @@ def parse_arguments(argv: Optional[Sequence[str]] = None) -> argparse.Namespace:
     return parser.parse_args(argv)
 
 
-def parse_mapping(mapping_file: Optional[IO]) -> configparser.ConfigParser:
+def parse_mapping(mapping_file: Optional[Path]) -> configparser.ConfigParser:
     """Parse the file containing the mappings from hosts to pass entries.
 
     Args:
@@ -83,6 +109,8 @@ def parse_mapping(mapping_file: Optional[IO]) -> configparser.ConfigParser:
             Name of the file to parse. If ``None``, the default file from the
             XDG location is used.
     """
+    import configparser
+
     LOGGER.debug("Parsing mapping file. Command line: %s", mapping_file)
 
     def parse(mapping_file: IO) -> configparser.ConfigParser:
@@ -93,14 +121,17 @@ def parse_mapping(mapping_file: Optional[IO]) -> configparser.ConfigParser:
     # give precedence to the user-specified file
     if mapping_file is not None:
         LOGGER.debug("Parsing command line mapping file")
-        return parse(mapping_file)
+        with mapping_file.open("r") as file_handle:
+            return parse(file_handle)
 
     # fall back on XDG config location
+    import xdg.BaseDirectory
+
     xdg_config_dir = xdg.BaseDirectory.load_first_config("pass-git-helper")
     if xdg_config_dir is None:
         raise RuntimeError(
             "No mapping configured so far at any XDG config location. "
-            "Please create {config_file}".format(config_file=DEFAULT_CONFIG_FILE)
+            "Please create {config_file}".format(config_file=_default_config_file())
         )
     default_file = Path(xdg_config_dir) / CONFIG_FILE_NAME
     LOGGER.debug("Parsing mapping file %s", mapping_file)
@@ -114,18 +145,18 @@ def parse_request() -> Dict[str, str]:
     Returns:
         A dictionary with all key-value pairs of the request
     """
-    in_lines = sys.stdin.readlines()
+    # only split at newlines like git does, values may contain other line
+    # boundaries such as form feeds
+    in_lines = sys.stdin.read().split("\n")
     LOGGER.debug('Received request "%s"', in_lines)
 
     request = {}
     for line in in_lines:
-        # skip empty lines to be a bit resilient against protocol errors
-        if not line.strip():
-            continue
-
-        parts = line.split("=", 1)
-        assert len(parts) == 2
-        request[parts[0].strip()] = parts[1].strip()
+        # skip lines without a key-value pair, e.g. empty ones, to be a bit
+        # resilient against protocol errors
+        key, separator, value = line.partition("=")
+        if separator:
+            request[key.strip()] = value.strip()
 
     return request
 
@@ -133,6 +164,8 @@ def parse_request() -> Dict[str, str]:
 class DataExtractor(abc.ABC):
     """Interface for classes that extract values from pass entries."""
 
+    __slots__ = ("_option_suffix",)
+
     def __init__(self, option_suffix: Text = "") -> None:
         """Create a new instance.
 
@@ -176,6 +209,8 @@ class SkippingDataExtractor(DataExtractor):
     The prefix is a fixed amount of characters.
     """
 
+    __slots__ = ("_default_prefix_length", "_prefix_length", "_skip_option")
+
     def __init__(self, prefix_length: int, option_suffix: Text = "") -> None:
         """Create a new instance.
 
@@ -187,14 +222,15 @@ class SkippingDataExtractor(DataExtractor):
                 instance. Subclasses must use this for their own options.
         """
         super().__init__(option_suffix)
+        self._skip_option = "skip{suffix}".format(suffix=option_suffix)
+        self._default_prefix_length = prefix_length
         self._prefix_length = prefix_length
 
     @abc.abstractmethod
     def configure(self, config: configparser.SectionProxy) -> None:
         """Configure the amount of characters to skip."""
         self._prefix_length = config.getint(
-            "skip{suffix}".format(suffix=self._option_suffix),
-            fallback=self._prefix_length,
+            self._skip_option, fallback=self._default_prefix_length
         )
 
     @abc.abstractmethod
@@ -215,6 +251,8 @@ class SkippingDataExtractor(DataExtractor):
 class SpecificLineExtractor(SkippingDataExtractor):
     """Extracts a specific line number from an entry."""
 
+    __slots__ = ("_default_line", "_line", "_line_option")
+
     def __init__(self, line: int, prefix_length: int, option_suffix: Text = "") -> None:
         """Create a new instance.
 
@@ -227,14 +265,14 @@ class SpecificLineExtractor(SkippingDataExtractor):
                 Suffix for each configuration option
         """
         super().__init__(prefix_length, option_suffix)
+        self._line_option = "line{suffix}".format(suffix=option_suffix)
+        self._default_line = line
         self._line = line
 
     def configure(self, config: configparser.SectionProxy) -> None:
         """See base class method."""
         super().configure(config)
-        self._line = config.getint(
-            "line{suffix}".format(suffix=self._option_suffix), fallback=self._line
-        )
+        self._line = config.getint(self._line_option, fallback=self._default_line)
 
     def _get_raw(
         self, entry_name: Text, entry_lines: Sequence[Text]  # noqa: ARG002
@@ -245,9 +283,39 @@ class SpecificLineExtractor(SkippingDataExtractor):
             return None
 
 
+@functools.lru_cache(maxsize=64)
+def _build_matcher(regex: str) -> Pattern:
+    """Compile a regular expression for extracting values from entries.
+
+    Compiled expressions are memoized so that repeatedly configuring the same
+    expression does not compile it again.
+
+    Args:
+        regex:
+            The regular expression to compile. It must contain a single capture
+            group for the value to return.
+
+    Returns:
+        The compiled expression.
+
+    Raises:
+        ValueError:
+            The expression does not contain exactly one capture group.
+    """
+    matcher = re.compile(regex)
+    if matcher.groups != 1:
+        raise ValueError(
+            'Provided regex "{regex}" must contain a single '
+            "capture group for the value to return.".format(regex=regex)
+        )
+    return matcher
+
+
 class RegexSearchExtractor(DataExtractor):
     """Extracts data using a regular expression with capture group."""
 
+    __slots__ = ("_default_regex", "_regex", "_regex_option")
+
     def __init__(self, regex: str, option_suffix: str) -> None:
         """Create a new instance.
 
@@ -260,24 +328,14 @@ class RegexSearchExtractor(DataExtractor):
                 Suffix for each configuration option
         """
         super().__init__(option_suffix)
-        self._regex = self._build_matcher(regex)
-
-    def _build_matcher(self, regex: str) -> Pattern:
-        matcher = re.compile(regex)
-        if matcher.groups != 1:
-            raise ValueError(
-                'Provided regex "{regex}" must contain a single '
-                "capture group for the value to return.".format(regex=regex)
-            )
-        return matcher
+        self._regex_option = "regex{suffix}".format(suffix=option_suffix)
+        self._default_regex = _build_matcher(regex)
+        self._regex = self._default_regex
 
     def configure(self, config: configparser.SectionProxy) -> None:
         """See base class method."""
-        self._regex = self._build_matcher(
-            config.get(
-                "regex{suffix}".format(suffix=self._option_suffix),
-                fallback=self._regex.pattern,
-            )
+        self._regex = _build_matcher(
+            config.get(self._regex_option, fallback=self._default_regex.pattern)
         )
 
     def get_value(
@@ -296,6 +354,8 @@ class RegexSearchExtractor(DataExtractor):
 class EntryNameExtractor(DataExtractor):
     """Return the last path fragment of the pass entry as the desired value."""
 
+    __slots__ = ()
+
     def configure(self, config: configparser.SectionProxy) -> None:
         """Configure nothing."""
 
@@ -303,10 +363,11 @@ class EntryNameExtractor(DataExtractor):
         self, entry_name: Text, entry_lines: Sequence[Text]  # noqa: ARG002
     ) -> Optional[Text]:
         """See base class method."""
-        return os.path.split(entry_name)[1]
+        return entry_name.rpartition("/")[2]
 
 
 _line_extractor_name = "specific_line"
+_password_extractor = SpecificLineExtractor(0, 0, option_suffix="_password")
 _username_extractors = {
     _line_extractor_name: SpecificLineExtractor(1, 0, option_suffix="_username"),
     "regex_search": RegexSearchExtractor(
@@ -316,20 +377,41 @@ _username_extractors = {
 }
 
 
+_GLOB_CHARACTERS: FrozenSet[str] = frozenset("*?[")
+
+
+def _select_section(sections: Sequence[str], request_header: str) -> Optional[str]:
+    """Return the first section in file order matching the request header.
+
+    Sections without glob characters can only match a header equal to them and
+    are therefore compared directly instead of through fnmatch.
+    """
+    import fnmatch
+
+    for section in sections:
+        if _GLOB_CHARACTERS.isdisjoint(section):
+            if section == request_header:
+                return section
+        elif fnmatch.fnmatch(request_header, section):
+            return section
+    return None
+
+
 def find_mapping_section(
     mapping: configparser.ConfigParser, request_header: str
 ) -> configparser.SectionProxy:
     """Select the mapping entry matching the request header."""
     LOGGER.debug('Searching mapping to match against header "%s"', request_header)
-    for section in mapping.sections():
-        if fnmatch.fnmatch(request_header, section):
-            LOGGER.debug(
-                'Section "%s" matches requested header "%s"', section, request_header
-            )
-            return mapping[section]
+    sections = mapping.sections()
+    section = _select_section(sections, request_header)
+    if section is not None:
+        LOGGER.debug(
+            'Section "%s" matches requested header "%s"', section, request_header
+        )
+        return mapping[section]
 
     raise ValueError(
-        f"No mapping section in {mapping.sections()} matches request {request_header}"
+        f"No mapping section in {sections} matches request {request_header}"
     )
 
 
@@ -345,25 +427,54 @@ def get_request_section_header(request: Mapping[str, str]) -> str:
     return host
 
 
+_TARGET_VARIABLE = re.compile(r"\$\{(host|username|protocol)\}")
+
+
 def define_pass_target(
     section: configparser.SectionProxy, request: Mapping[str, str]
 ) -> str:
-    """Determine the pass target by filling in potentially used variables."""
-    pass_target = section["target"].replace("${host}", request["host"])
-    if "username" in request:
-        pass_target = pass_target.replace("${username}", request["username"])
-    if "protocol" in request:
-        pass_target = pass_target.replace("${protocol}", request["protocol"])
-    return pass_target
+    """Determine the pass target by filling in potentially used variables.
+
+    Variables without a value in the request are kept verbatim.
+    """
+    target = section["target"]
+    if "$" not in target:
+        return target
+    return _TARGET_VARIABLE.sub(
+        lambda match: request.get(match.group(1), match.group(0)), target
+    )
 
 
-def compute_pass_environment(section: configparser.SectionProxy) -> Mapping[str, str]:
-    environment = os.environ.copy()
+def compute_pass_environment(
+    section: configparser.SectionProxy,
+) -> Optional[Mapping[str, str]]:
+    """Return the environment for calling pass.
+
+    Returns:
+        ``None`` if pass can inherit the environment of this process, else the
+        full environment to use.
+    """
     password_store_dir = section.get("password_store_dir")
-    if password_store_dir:
-        LOGGER.debug('Setting PASSWORD_STORE_DIR to "%s"', password_store_dir)
-        environment["PASSWORD_STORE_DIR"] = password_store_dir
-    return environment
+    if not password_store_dir:
+        return None
+    LOGGER.debug('Setting PASSWORD_STORE_DIR to "%s"', password_store_dir)
+    return {**os.environ, "PASSWORD_STORE_DIR": password_store_dir}
+
+
+def _configure_username_extractor(
+    section: configparser.SectionProxy,
+) -> DataExtractor:
+    """Select and configure the username extractor requested by a section."""
+    username_extractor_name: str = section.get(  # type: ignore
+        "username_extractor", fallback=_line_extractor_name
+    )
+    username_extractor = _username_extractors.get(username_extractor_name)
+    if username_extractor is None:
+        raise ValueError(
+            f"A username_extractor of type '{username_extractor_name}' does not exist"
+        )
+    username_extractor.configure(section)
+    return username_extractor
 
 
 def get_password(
@@ -379,6 +490,8 @@ def get_password(
         mapping:
             The mapping configuration as a ConfigParser instance.
     """
+    import subprocess
+
     LOGGER.debug('Received request "%s"', request)
 
     header = get_request_section_header(request)
@@ -386,18 +499,12 @@ def get_password(
 
     pass_target = define_pass_target(section, request)
 
-    password_extractor = SpecificLineExtractor(0, 0, option_suffix="_password")
-    password_extractor.configure(section)
+    _password_extractor.configure(section)
 
-    username_extractor_name: str = section.get(  # type: ignore
-        "username_extractor", fallback=_line_extractor_name
-    )
-    username_extractor = _username_extractors.get(username_extractor_name)
-    if username_extractor is None:
-        raise ValueError(
-            f"A username_extractor of type '{username_extractor_name}' does not exist"
-        )
-    username_extractor.configure(section)
+    # a username provided by git is never overridden, no need to extract one
+    username_extractor = None
+    if "username" not in request:
+        username_extractor = _configure_username_extractor(section)
 
     environment = compute_pass_environment(section)
 
@@ -409,12 +516,15 @@ def get_password(
     ).decode(section.get("encoding", "UTF-8"))
     lines = output.splitlines()
 
-    password = password_extractor.get_value(pass_target, lines)
-    username = username_extractor.get_value(pass_target, lines)
+    response = []
+    password = _password_extractor.get_value(pass_target, lines)
     if password:
-        print("password={password}".format(password=password))  # noqa: T201
-    if "username" not in request and username:
-        print("username={username}".format(username=username))  # noqa: T201
+        response.append("password={password}\n".format(password=password))
+    if username_extractor is not None:
+        username = username_extractor.get_value(pass_target, lines)
+        if username:
+            response.append("username={username}\n".format(username=username))
+    sys.stdout.write("".join(response))
 
 
 def handle_skip() -> None:
@@ -432,13 +542,14 @@ def main(argv: Optional[Sequence[str]] = None) -> None:
             If not ``None``, use the provided command line arguments for
             parsing. Otherwise, extract them automatically.
     """
+    # skip before parsing arguments so that the skip path does not pay for it
+    handle_skip()
+
     args = parse_arguments(argv=argv)
 
     if args.logging:
         logging.basicConfig(level=logging.DEBUG)
 
-    handle_skip()
-
     action = args.action
     request = parse_request()
     LOGGER.debug("Received action %s with request:\n%s", action, request)
@@ -1,8 +1,10 @@
 import configparser
 from dataclasses import dataclass
 import io
+from pathlib import Path
 from subprocess import CalledProcessError
-from typing import Any, Iterable, Optional, Sequence, Text
+import sys
+from typing import Any, Dict, Iterable, Optional, Sequence, Text
 from unittest.mock import ANY
 
 import pytest
@@ -11,7 +13,7 @@ from pytest_mock import MockerFixture
 import passgithelper
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class HelperConfig:
     xdg_dir: Optional[str]
     request: str
@@ -20,14 +22,15 @@ class HelperConfig:
 
 
 @pytest.fixture
-def helper_config(mocker: MockerFixture, request: Any) -> Iterable[Any]:
-    xdg_mock = mocker.patch("xdg.BaseDirectory.load_first_config")
-    xdg_mock.return_value = request.param.xdg_dir
-
-    mocker.patch("sys.stdin.readlines").return_value = io.StringIO(
-        request.param.request
+def helper_config(
+    mocker: MockerFixture, monkeypatch: Any, request: Any
+) -> Iterable[Any]:
+    monkeypatch.setattr(
+        "xdg.BaseDirectory.load_first_config", lambda *_: request.param.xdg_dir
     )
 
+    monkeypatch.setattr("sys.stdin", io.StringIO(request.param.request))
+
     subprocess_mock = mocker.patch("subprocess.check_output")
     if request.param.entry_data:
         subprocess_mock.return_value = request.param.entry_data
@@ -43,6 +46,22 @@ def helper_config(mocker: MockerFixture, request: Any) -> Iterable[Any]:
         )
 
 
+def test_parse_request(monkeypatch: Any) -> None:
+    monkeypatch.setattr(
+        "sys.stdin",
+        io.StringIO(
+            "protocol=https\n\nhost=mytest.com\nbroken\npath = a=b \n"
+            "username=first\x0csecond\n"
+        ),
+    )
+    assert passgithelper.parse_request() == {
+        "protocol": "https",
+        "host": "mytest.com",
+        "path": "a=b",
+        "username": "first\x0csecond",
+    }
+
+
 def test_handle_skip_nothing(monkeypatch: Any) -> None:
     monkeypatch.delenv("PASS_GIT_HELPER_SKIP", raising=False)
     passgithelper.handle_skip()
@@ -90,6 +109,24 @@ class TestSpecificLineExtractor:
         extractor = passgithelper.SpecificLineExtractor(3, 6)
         assert extractor.get_value("foo", ["line 1", "user: bar", "more lines"]) is None
 
+    def test_configuration_falls_back_to_defaults(self) -> None:
+        extractor = passgithelper.SpecificLineExtractor(0, 0, "_password")
+        config = configparser.ConfigParser()
+        config.read_string(
+            """[custom]
+line_password=1
+skip_password=6
+
+[plain]"""
+        )
+        lines = ["secret", "user: bar"]
+
+        extractor.configure(config["custom"])
+        assert extractor.get_value("foo", lines) == "bar"
+
+        extractor.configure(config["plain"])
+        assert extractor.get_value("foo", lines) == "secret"
+
 
 class TestRegexSearchExtractor:
     def test_smoke(self) -> None:
@@ -121,6 +158,14 @@ regex_username=^foo: (.*)$"""
         extractor.configure(config["test"])
         assert extractor._regex.pattern == r"^foo: (.*)$"
 
+    def test_configuration_reuses_compiled_pattern(self) -> None:
+        extractor = passgithelper.RegexSearchExtractor("^username: (.*)$", "_username")
+        config = configparser.ConfigParser()
+        config.read_string("[test]")
+        hits = passgithelper._build_matcher.cache_info().hits
+        extractor.configure(config["test"])
+        assert passgithelper._build_matcher.cache_info().hits == hits + 1
+
     def test_configuration_checks_groups(self) -> None:
         extractor = passgithelper.RegexSearchExtractor("^username: (.*)$", "_username")
         config = configparser.ConfigParser()
@@ -150,7 +195,7 @@ class TestEntryNameExtractor:
 )
 @pytest.mark.usefixtures("helper_config")
 def test_parse_mapping_file_missing() -> None:
-    with pytest.raises(RuntimeError):
+    with pytest.raises(RuntimeError, match=passgithelper.CONFIG_FILE_NAME):
         passgithelper.parse_mapping(None)
 
 
@@ -172,6 +217,110 @@ def test_parse_mapping_from_xdg() -> None:
     assert config["mytest.com"]["target"] == "dev/mytest"
 
 
+def test_parse_mapping_from_path() -> None:
+    config = passgithelper.parse_mapping(Path("test_data/smoke/git-pass-mapping.ini"))
+    assert config["mytest.com"]["target"] == "dev/mytest"
+
+
+def test_parse_mapping_path_missing() -> None:
+    with pytest.raises(FileNotFoundError):
+        passgithelper.parse_mapping(Path("test_data/does-not-exist.ini"))
+
+
+def test_explicit_mapping_does_not_load_xdg(monkeypatch: Any) -> None:
+    monkeypatch.delitem(sys.modules, "xdg.BaseDirectory", raising=False)
+
+    args = passgithelper.parse_arguments(
+        ["-m", "test_data/smoke/git-pass-mapping.ini", "get"]
+    )
+
+    assert args.mapping == Path("test_data/smoke/git-pass-mapping.ini")
+    assert "xdg.BaseDirectory" not in sys.modules
+
+
+class TestFindMappingSection:
+    def test_first_match_wins(self) -> None:
+        config = configparser.ConfigParser()
+        config.read_string(
+            """[mytest.com/special/*]
+target=dev/special
+
+[mytest.com*]
+target=dev/mytest
+
+[*]
+target=dev/fallback"""
+        )
+        assert (
+            passgithelper.find_mapping_section(config, "mytest.com/special/bar.git")[
+                "target"
+            ]
+            == "dev/special"
+        )
+        assert (
+            passgithelper.find_mapping_section(config, "mytest.com/other.git")["target"]
+            == "dev/mytest"
+        )
+        assert (
+            passgithelper.find_mapping_section(config, "other.com")["target"]
+            == "dev/fallback"
+        )
+
+    def test_earlier_glob_wins_over_literal(self) -> None:
+        config = configparser.ConfigParser()
+        config.read_string(
+            """[other.com]
+target=dev/other
+
+[*.com]
+target=dev/glob
+
+[mytest.com]
+target=dev/mytest"""
+        )
+        assert (
+            passgithelper.find_mapping_section(config, "other.com")["target"]
+            == "dev/other"
+        )
+        assert (
+            passgithelper.find_mapping_section(config, "mytest.com")["target"]
+            == "dev/glob"
+        )
+
+    def test_no_match(self) -> None:
+        config = configparser.ConfigParser()
+        config.read_string(
+            """[mytest.com]
+target=dev/mytest"""
+        )
+        with pytest.raises(ValueError, match="No mapping section"):
+            passgithelper.find_mapping_section(config, "mytest.com.evil")
+
+    def test_empty_mapping(self) -> None:
+        with pytest.raises(ValueError, match="No mapping section"):
+            passgithelper.find_mapping_section(configparser.ConfigParser(), "any")
+
+
+@pytest.mark.parametrize(
+    ("request_data", "expected"),
+    [
+        ({"host": "mytest.com"}, "dev/${protocol}/mytest.com/${username}"),
+        (
+            {"host": "mytest.com", "protocol": "https", "username": "me"},
+            "dev/https/mytest.com/me",
+        ),
+        ({"host": "${username}", "username": "me"}, "dev/${protocol}/${username}/me"),
+    ],
+)
+def test_define_pass_target(request_data: Dict[str, str], expected: str) -> None:
+    config = configparser.ConfigParser()
+    config.read_string(
+        """[test]
+target=dev/${protocol}/${host}/${username}"""
+    )
+    assert passgithelper.define_pass_target(config["test"], request_data) == expected
+
+
 class TestScript:
     def test_help(self, capsys: Any) -> None:
         with pytest.raises(SystemExit):
@@ -187,6 +336,15 @@ class TestScript:
         assert not out
         assert not err
 
+    def test_skip_before_argument_parsing(self, monkeypatch: Any, capsys: Any) -> None:
+        monkeypatch.setenv("PASS_GIT_HELPER_SKIP", "1")
+        with pytest.raises(SystemExit) as exit_info:
+            passgithelper.main(["--no-such-option"])
+        assert exit_info.value.code == 1
+        out, err = capsys.readouterr()
+        assert not out
+        assert not err
+
     @pytest.mark.parametrize(
         "helper_config",
         [
@@ -379,6 +537,28 @@ host=mytest.com""",
         _, err = capsys.readouterr()
         assert "username_extractor of type 'doesntexist' does not exist" in err
 
+    @pytest.mark.parametrize(
+        "helper_config",
+        [
+            HelperConfig(
+                "test_data/unknown-username-extractor",
+                """
+protocol=https
+host=mytest.com
+username=narf""",
+                b"password",
+                "dev/mytest",
+            ),
+        ],
+        indirect=True,
+    )
+    @pytest.mark.usefixtures("helper_config")
+    def test_extractor_ignored_if_username_provided(self, capsys: Any) -> None:
+        passgithelper.main(["get"])
+
+        out, _ = capsys.readouterr()
+        assert out == "password=password\n"
+
     @pytest.mark.parametrize(
         "helper_config",
         [
@@ -529,3 +709,22 @@ host=example.com""",
             helper_config.mock_calls[-1].kwargs["env"]["PASSWORD_STORE_DIR"]
             == "/some/dir"
         )
+
+    @pytest.mark.parametrize(
+        "helper_config",
+        [
+            HelperConfig(
+                "test_data/smoke",
+                """
+protocol=https
+host=mytest.com""",
+                b"narf",
+                "dev/mytest",
+            ),
+        ],
+        indirect=True,
+    )
+    def test_inherits_environment_by_default(self, helper_config: Any) -> None:
+        passgithelper.main(["get"])
+
+        assert helper_config.mock_calls[-1].kwargs["env"] is None